@@ -1,32 +1,177 @@
+import atexit
 import datetime
+import locale
+import mmap
 import os
 import subprocess
 from threading import Lock,Event,Thread
-from multiprocessing import Process
-import time
+from multiprocessing import Process,Queue,Pipe
+import queue
 import re
 import psutil
 import traceback
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
 from .constants import CONFIG
 
-#set at the module level in order to override from another module if so desired
-print = print
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    #watchdog is optional, without it LogWatcher checks the log once every _LOG_POLL_INTERVAL seconds
+    Observer = None
+    #only so _LogChangeHandler can still be defined, it's never instantiated without watchdog
+    FileSystemEventHandler = object
 
-print_lock = Lock()
+#what the print worker prints with, replace it with set_printer
+_printer = print
+
+def set_printer(printer):
+    '''overrides the function used to print every LogWatcher and DemandToolsCommand message, it is called with one string per batch of messages'''
+    global _printer
+    _printer = printer
+
+class _PrintWorker(Thread):
+    '''
+    the only thread that prints. LogWatchers and DemandToolsCommands put their messages on its queue instead of contending for stdout,
+    and whatever has piled up is printed in a single call. Commands running in their own process go through _PrintRelay
+    '''
+    def __init__(self):
+        super().__init__(name='DemandToolsPrintWorker',daemon=True)
+        self.queue = queue.SimpleQueue()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while True:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            messages = []
+            #events of print_now callers waiting for their message to be printed
+            printed_events = []
+            closed = False
+            for item in batch:
+                #None is put by close and is the last message printed
+                if item is None:
+                    closed = True
+                    break
+                if isinstance(item,tuple):
+                    item,printed = item
+                    printed_events.append(printed)
+                messages.append(item)
+            try:
+                if messages:
+                    _printer('\n'.join(messages))
+            finally:
+                for printed in printed_events:
+                    printed.set()
+            if closed:
+                return
+
+    def print_now(self,message):
+        '''blocks until message, and everything queued before it, has been printed'''
+        printed = Event()
+        self.queue.put((message,printed))
+        printed.wait()
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+
+class _PrintRelay(Thread):
+    '''forwards messages from commands running in their own process to the print worker, the worker's queue can't be shared between processes'''
+    def __init__(self,print_queue):
+        super().__init__(name='DemandToolsPrintRelay',daemon=True)
+        self.queue = Queue()
+        self.print_queue = print_queue
+
+    def run(self):
+        while True:
+            message = self.queue.get()
+            if message is None:
+                return
+            self.print_queue.put(message)
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+
+_print_worker = None
+_print_relay = None
+_print_worker_lock = Lock()
+
+def _get_print_queue():
+    '''starts the print worker on first use and returns its queue'''
+    global _print_worker
+    with _print_worker_lock:
+        if _print_worker is None:
+            _print_worker = _PrintWorker()
+            _print_worker.start()
+            #the worker is a daemon, make sure what's left in its queue is printed before the interpreter exits
+            atexit.register(_print_worker.close)
+    return _print_worker.queue
+
+def _get_process_print_queue():
+    '''starts the print relay on first use and returns the queue commands running in their own process print to'''
+    global _print_relay
+    print_queue = _get_print_queue()
+    with _print_worker_lock:
+        if _print_relay is None:
+            _print_relay = _PrintRelay(print_queue)
+            _print_relay.start()
+            #registered after the worker's close so it runs first, handing the worker everything still in the relay
+            atexit.register(_print_relay.close)
+    return _print_relay.queue
+
+def _print_now(message):
+    '''prints message before returning, after everything already queued in this process'''
+    worker = _print_worker
+    #in a command's own process the print worker isn't running, messages queued there are printed by the parent
+    if worker is not None and worker.is_alive():
+        worker.print_now(message)
+    else:
+        _printer(message)
+
+#compiled once since they run against every line of the DemandTools log
+_COMMA_RUN_RE = re.compile(rb',+')
+#lines are split on newlines before they get here, only quotes are left to strip
+_QUOTE_RE = re.compile(rb'"+')
+
+#seconds to wait between checks of the log when no change has been reported
+_LOG_POLL_INTERVAL = 1
+
+class _LogChangeHandler(FileSystemEventHandler):
+    '''watchdog event handler that sets log_changed for any event on log_path'''
+    def __init__(self,log_path,log_changed):
+        super().__init__()
+        self.log_path=os.path.normcase(log_path)
+        self.log_changed=log_changed
+
+    def on_any_event(self,event):
+        paths = (event.src_path,getattr(event,'dest_path',''))
+        if any(os.path.normcase(path)==self.log_path for path in paths):
+            self.log_changed.set()
 
 class LogWatcher(Thread):
     def __init__(self,organization_id=None,max_line_length=120,log_queue=None):
         super().__init__()
+        self._print_queue=_get_print_queue()
         self.organization_id=organization_id
         self._stop_event = Event()
+        #set whenever the log might have changed, and on stop so a waiting watcher notices right away
+        self._log_changed = Event()
         self.max_line_length=max_line_length
         self.log_queue=log_queue
+        #the encoding open() would have read the log with
+        self._log_encoding=locale.getpreferredencoding(False)
     
     def stop(self):
-        with print_lock:
-            print('DemandTools LogWatcher stopped.')
+        self._print_queue.put('DemandTools LogWatcher stopped.')
         self._stop_event.set()
+        self._log_changed.set()
 
     def __exit__(self,type,value,traceback):
         self.stop()
@@ -38,7 +183,7 @@ class LogWatcher(Thread):
     def _print(self,message):
         if self.log_queue:
             self.log_queue.put(message)
-        print(message)
+        self._print_queue.put(message)
 
     @property
     def stopped(self):
@@ -49,76 +194,138 @@ class LogWatcher(Thread):
         if self.organization_id:
             log_directory = os.path.join(base_log_directory,self.organization_id)
         else:
-            try:
-                first_org_folder = [item for item in os.listdir(base_log_directory) if os.path.isdir(os.path.join(base_log_directory,item))][0]
-                log_directory = os.path.join(base_log_directory,first_org_folder)
-            except IndexError:
+            with os.scandir(base_log_directory) as entries:
+                first_org_folder = next((entry.name for entry in entries if entry.is_dir()),None)
+            if first_org_folder is None:
                 self.stop()
-                with print_lock:
-                    raise Exception('No log folders found in {b}'.format(base_log_directory))
+                raise Exception('No log folders found in {b}'.format(b=base_log_directory))
+            log_directory = os.path.join(base_log_directory,first_org_folder)
             
         expected_log_name='DemandToolsLog_{date}.txt'.format(date=datetime.date.today().strftime('%b%d%Y'))
 
         log_path = os.path.join(log_directory,expected_log_name)
-        with print_lock:
-            self._print('DemandTools LogWatcher initialized. Watching "{file_name}" for changes'.format(file_name=log_path))
+        self._print('DemandTools LogWatcher initialized. Watching "{file_name}" for changes'.format(file_name=log_path))
         
-        while not os.path.exists(log_path):
-            if self.stopped:
-                return
-            time.sleep(1)                
+        observer = self._watch_log(log_directory,log_path)
+        try:
+            while True:
+                #cleared before looking at the log so a change made while looking still wakes the next wait
+                self._log_changed.clear()
+                if self.stopped:
+                    return
+                #opening the log is the existence check, there's no separate stat for it
+                try:
+                    fd = os.open(log_path,os.O_RDONLY)
+                    break
+                except FileNotFoundError:
+                    self._wait_for_log_change()
+            self._follow_log(fd)
+        finally:
+            if observer is not None:
+                observer.stop()
+                observer.join()
 
-        file = open(log_path)
-        #got to end of file so as to only look for new lines
-        file.seek(0,2)
+    def _watch_log(self,log_directory,log_path):
+        '''wakes _wait_for_log_change as soon as the log is created or written to. Returns None when watchdog isn't installed or can't watch log_directory'''
+        if Observer is None:
+            return None
+        observer = Observer()
+        try:
+            observer.schedule(_LogChangeHandler(log_path,self._log_changed),log_directory,recursive=False)
+            observer.start()
+        except OSError:
+            #the log directory doesn't exist until demandtools creates it, poll for the log the same way as without watchdog
+            return None
+        return observer
 
-        while True:
-            if self.stopped:
-                return
-            where = file.tell()
-            line = file.readline()
-            if not line:
-                time.sleep(1)
-                file.seek(where)
-            else:
-                if line.replace("\n","")!="":
-                    #first part of the line is a timestamp which we don't care about. Trim it off
-                    if ',' in line:
-                        line = line[line.index(',')+1:]
-                    #remove commas and replace with pipes
-                    line = re.sub(",+","|",line)
-                    #remove new lines and quotes
-                    line = re.sub('(\n|")+','',line)
-                    line = line.strip()
-                    with print_lock:
-                        self._print('DTLog>>> {newline}'.format(newline=line[:self.max_line_length]))
-
-def DemandToolsExceptionFactory(demand_tools_stderr_string):
-    '''generates exception classes by parsing the standard out from demandtools exceptions'''
-    
-    class Sentence():
-        def __init__(self,content,is_present=False):
-            self.content=content
-            self.is_present=is_present
-        
-    def sentences_in_demand_tools_stderr(sentences):
-        for index,sentence in enumerate(sentences):
-            if sentence.content in demand_tools_stderr_string:
-                sentences[index].is_present=True
-        return all([sentence.is_present for sentence in sentences])
-    
-    def is_db_access_collision_exception():
-        return sentences_in_demand_tools_stderr([
-                Sentence('because it is being used by another process'),
-                Sentence('The process cannot access the file')
-            ])
-            
-    def is_object_reference_exception():
-        return sentences_in_demand_tools_stderr([Sentence('Object reference not set to an instance of an object')])
-        
-    if is_db_access_collision_exception():
+    def _wait_for_log_change(self):
+        #the timeout is kept with watchdog as well since Windows can delay reporting writes to a file that is held open
+        self._log_changed.wait(_LOG_POLL_INTERVAL)
+
+    def _follow_log(self,fd):
+        '''prints lines as they are added to the log open at fd, closing it once the watcher is stopped'''
+        log_map = None
+        #bytes after the last newline, completed by a later write
+        partial_line = b''
+        try:
+            #go to end of file so as to only look for new lines
+            position = os.fstat(fd).st_size
+            while True:
+                self._log_changed.clear()
+                if self.stopped:
+                    return
+                size = os.fstat(fd).st_size
+                if size<=position:
+                    self._wait_for_log_change()
+                    continue
+                if log_map is None or size>len(log_map):
+                    #the log grew past the mapped region, remap it at its new size
+                    if log_map is not None:
+                        log_map.close()
+                    log_map = self._map_log(fd,size)
+                *lines,partial_line = (partial_line+log_map[position:size]).split(b'\n')
+                position = size
+                for line in lines:
+                    self._print_log_line(line)
+        finally:
+            if log_map is not None:
+                log_map.close()
+            os.close(fd)
+
+    @staticmethod
+    def _map_log(fd,size):
+        log_map = mmap.mmap(fd,size,access=mmap.ACCESS_READ)
+        #the log is only ever read front to back. madvise isn't available on Windows
+        if hasattr(mmap,'MADV_SEQUENTIAL'):
+            log_map.madvise(mmap.MADV_SEQUENTIAL)
+        return log_map
+
+    def _print_log_line(self,line):
+        '''line is the raw bytes of the log line, it's only decoded once it has been trimmed'''
+        line = line.rstrip(b'\r')
+        if line!=b"":
+            #first part of the line is a timestamp which we don't care about. Trim it off
+            _,comma,message = line.partition(b',')
+            if comma:
+                line = message
+            #the substitutions are skipped for lines that don't need them, checking is far cheaper than a sub
+            #remove commas and replace with pipes
+            if b',' in line:
+                line = _COMMA_RUN_RE.sub(b'|',line)
+            #remove quotes
+            if b'"' in line:
+                line = _QUOTE_RE.sub(b'',line)
+            line = line.decode(self._log_encoding,'replace').strip()
+            self._print('DTLog>>> {newline}'.format(newline=line[:self.max_line_length]))
+
+def _build_startupinfo(show_window_setting):
+    info = subprocess.STARTUPINFO()
+    info.dwFlags = subprocess.STARTF_USESHOWWINDOW
+    info.wShowWindow = show_window_setting
+    return info
+
+#built once and shared by every command, Popen copies the startupinfo it is given before modifying it.
+#STARTUPINFO only exists on Windows
+if hasattr(subprocess,'STARTUPINFO'):
+    #hide window
+    _STARTUPINFO_HIDE = _build_startupinfo(0)
+    #maximize window
+    _STARTUPINFO_SHOW = _build_startupinfo(3)
+else:
+    _STARTUPINFO_HIDE = _STARTUPINFO_SHOW = None
+
+#the most bytes of a demandtools process' stderr held on to
+_STDERR_TAIL_SIZE = 64*1024
+
+#sentences that must all be present in demandtools' stderr for it to be the corresponding exception
+_DB_COLLISION = (b'because it is being used by another process',b'The process cannot access the file')
+_OBJECT_REFERENCE = (b'Object reference not set to an instance of an object',)
+
+def DemandToolsExceptionFactory(demand_tools_stderr):
+    '''generates exception classes by parsing the raw standard error bytes from demandtools exceptions'''
+    if all(sentence in demand_tools_stderr for sentence in _DB_COLLISION):
         return DemandToolsMultiProcessDBWriteConflictException
-    elif is_object_reference_exception():
+    elif all(sentence in demand_tools_stderr for sentence in _OBJECT_REFERENCE):
         return DemandToolsObjectReferenceException
     else:
         return DemandToolsCommandException
@@ -152,19 +359,23 @@ class DTWrapperConfigException(Exception):
 
 class DemandToolsCommand(Process):
     
-    _demand_tool_extension = {
+    #read only, these are shared by every command
+    _demand_tool_extension = MappingProxyType({
     
         'dedupe' : '.STDxml',
         'mass_effect' : '.MExml',
         'mass_effect_export' : '.DExml',
         'bulk_backup' : '.BBxml'
     
-    }
+    })
     
     print_prefix = 'DTCmd>>>'
     
-    #the reverse of _demand_tool_extension
-    _scenario_types = dict((v,k) for k,v in _demand_tool_extension.items())
+    #the reverse of _demand_tool_extension, built once along with the class
+    _scenario_types = MappingProxyType(dict((v,k) for k,v in _demand_tool_extension.items()))
+
+    #str.endswith accepts a tuple and checks every extension in one call
+    _demand_tool_extension_tuple = tuple(_demand_tool_extension.values())
 
 
     def __init__(self,
@@ -173,21 +384,25 @@ class DemandToolsCommand(Process):
             output_file=None,
             extra_dt_args=None,
             post_run_func=None,
-            post_run_func_args=(),
-            post_run_func_kwargs={},
+            post_run_func_args=None,
+            post_run_func_kwargs=None,
             debug=False,
             process_priority=psutil.IDLE_PRIORITY_CLASS,
-            exceptions_to_retry_on=[],
+            exceptions_to_retry_on=None,
             retry_count=0,
             log_queue=None
             ):
+        #replaced by start() when the command runs in its own process
+        self._print_queue=_get_print_queue()
+        #set by DemandToolsRunner to get back the exception raised in the command's own process
+        self._exception_connection=None
         self.scenario_path=scenario_path
         self.input_file=input_file
         self.output_file=output_file
         self.extra_dt_args=extra_dt_args
         self.post_run_func=post_run_func
-        self.post_run_func_args = post_run_func_args
-        self.post_run_func_kwargs = post_run_func_kwargs
+        self.post_run_func_args = () if post_run_func_args is None else post_run_func_args
+        self.post_run_func_kwargs = {} if post_run_func_kwargs is None else post_run_func_kwargs
         self.debug = debug
         self.process_priority = process_priority
         #if a different process is accessing DemandTool's local DB storage, DemandTools will throw an error.
@@ -198,9 +413,9 @@ class DemandToolsCommand(Process):
             self.raise_exception(
                 DemandToolsCommandException("scenario_path is a required argument")
             )
-        self.exceptions_to_retry_on=exceptions_to_retry_on
+        self.exceptions_to_retry_on=() if exceptions_to_retry_on is None else tuple(exceptions_to_retry_on)
         
-        if not all([issubclass(e,Exception) for e in self.exceptions_to_retry_on]):
+        if not all(issubclass(e,Exception) for e in self.exceptions_to_retry_on):
             self.raise_exception(
                 DemandToolsCommandException('All exceptions_to_retry_on must inherit from Exception')
             )
@@ -208,21 +423,15 @@ class DemandToolsCommand(Process):
             self.raise_exception(
                 DemandToolsCommandException('If you set either retry_count or exceptions_to_retry_on you must set the other as well')
             )
+        #the process is named after scenario_path, so it's fixed from here on and only parsed once
+        self._scenario_type,self._scenario_nice_name = self._parse_scenario_path()
         super().__init__(name=self.scenario_nice_name)
         self.log_queue=log_queue
 
     @property
     def _startupinfo(self):
         '''see https://stackoverflow.com/a/32121910/4188138 for more info and options'''
-        #hide window
-        SW_SETTING = 0
-        if self.debug:
-            #maximize window
-            SW_SETTING = 3
-        info = subprocess.STARTUPINFO()
-        info.dwFlags = subprocess.STARTF_USESHOWWINDOW
-        info.wShowWindow = SW_SETTING
-        return info
+        return _STARTUPINFO_SHOW if self.debug else _STARTUPINFO_HIDE
         
     @property
     def demand_tools_args(self):
@@ -241,32 +450,33 @@ class DemandToolsCommand(Process):
     def input_file_nice_name(self):
         if not self.input_file:
             return ''
-        nice_name = os.path.basename(self.input_file)
-        if '.' in nice_name:
-            extension = nice_name[nice_name.rfind('.'):]
-            nice_name = nice_name.replace(extension,'')
-        return nice_name
+        return os.path.splitext(os.path.basename(self.input_file))[0]
         
     @classmethod
     def get_scenarios_in_path(cls,*,path):
-        return [os.path.join(path,file) for file in os.listdir(path) if any([file.endswith(ext) for ext in cls._demand_tool_extension.values()])]
+        with os.scandir(path) as entries:
+            return [os.path.join(path,entry.name) for entry in entries if entry.name.endswith(cls._demand_tool_extension_tuple)]
         
-    @property
-    def scenario_type(self):
-        scenario_extension = self.scenario_path[self.scenario_path.rfind('.'):]
+    def _parse_scenario_path(self):
+        '''returns the scenario type and nice name of scenario_path, raising for unsupported extensions'''
+        scenario_extension = os.path.splitext(self.scenario_path)[1]
         try:
-            return self._scenario_types[scenario_extension]
+            scenario_type = self._scenario_types[scenario_extension]
         except KeyError as e:
             self.raise_exception(
                 DemandToolsCommandException('Unsupported extension "{e}" provided. Supported extensions are {se}'.format(
                     e=scenario_extension,
                     se=self._demand_tool_extension.values()
             )))
+        return scenario_type,os.path.basename(self.scenario_path)[:-len(scenario_extension)]
+
+    @property
+    def scenario_type(self):
+        return self._scenario_type
 
     @property
     def scenario_nice_name(self):
-        extension = self._demand_tool_extension[self.scenario_type]
-        return os.path.basename(self.scenario_path).replace(extension,"")
+        return self._scenario_nice_name
 
     @property
     def calculated_output_file_name(self):
@@ -280,14 +490,16 @@ class DemandToolsCommand(Process):
         date_pattern = datetime.date.today().strftime('%Y%m%d')
         #start at 1 if it hasn't been run yet (since this is the predicted file name)
         times_ran_today = 1
-        previous_runs = []
-        for file in os.listdir(file_dir):
-            pattern = r'{f}_{d}_([0-9])*\.csv'.format(f=file_name,d=date_pattern)
-            match = re.match(pattern,file)
-            if match and match.groups():
-                previous_runs.append(int(match.groups()[0]))
-        if previous_runs:
-            times_ran_today = max(previous_runs)+1
+        #demandtools names its output <file_name>_<date>_<run number>.csv
+        prefix = '{f}_{d}_'.format(f=file_name,d=date_pattern)
+        suffix = '.csv'
+        with os.scandir(file_dir) as entries:
+            for entry in entries:
+                name = entry.name
+                if name.startswith(prefix) and name.endswith(suffix):
+                    run_number = name[len(prefix):-len(suffix)]
+                    if run_number.isdecimal():
+                        times_ran_today = max(times_ran_today,int(run_number)+1)
         return '{output_file}_{date}_{times_ran}.csv'.format(
             output_file=os.path.join(file_dir,file_name),
             date=date_pattern,
@@ -297,57 +509,145 @@ class DemandToolsCommand(Process):
     def _print(self,message):
         if self.log_queue:
             self.log_queue.put(message)
-        with print_lock:
-            print('{p}{m}'.format(
-                p=DemandToolsCommand.print_prefix,
-                m=message
-            ))
+        self._print_queue.put('{p}{m}'.format(
+            p=DemandToolsCommand.print_prefix,
+            m=message
+        ))
             
     def raise_exception(self,exception_to_throw):
         #before we call super().__init__ the object has no name attribute
         name = '{process_name} Process'.format(process_name=self.name if hasattr(self,'name') else 'Unnamed')
         message = '{message}\nEnd Exception from {name}'.format(name=name,message=''.join([str(arg) for arg in exception_to_throw.args]))
-        with print_lock:
-            print('Start Exception from {name}'.format(name=name))
-            raise type(exception_to_throw)(message) from None
+        #printed before raising so it comes ahead of the exception and its End Exception line
+        _print_now('Start Exception from {name}'.format(name=name))
+        raise type(exception_to_throw)(message) from None
+
+    def start(self):
+        #pickled along with the command, so messages from its process are still printed by this process' print worker
+        self._print_queue=_get_process_print_queue()
+        super().start()
 
     def run(self):
+        '''called by start() in the command's own process, see execute'''
+        try:
+            self.execute()
+        except Exception as e:
+            if self._exception_connection is not None:
+                try:
+                    self._exception_connection.send(e)
+                except Exception:
+                    #the exception can't be pickled, the runner falls back to reporting the exit code
+                    pass
+            raise
+
+    def execute(self):
         '''
+        runs the command in the calling thread, this is what DemandToolsRunner submits to its thread pool
         !WARNING!
         Although DemandTools claims to officially support multiple instances of the process running simultaneously, I have personally encountered issues with multiprocessing
         https://skamensky.github.io/archives/validity/multiprocessing.html
         there are files that try to write to each other at the same time (temp database files) and DT simply crashing. When it crashes, there's nothing this package does to support
         recovery. However, if DT outputs standard output that indicates an error, you can use exceptions_to_retry_on to recuperate from those errors.
         '''
-        psutil.Process(os.getpid()).nice(self.process_priority)
-        
         if self.input_file:
             if not os.path.exists(self.input_file):
                 self.raise_exception(DemandToolsInputFileDoesNotExist('{input_file} does not exist'.format(input_file=self.input_file)))
-        self._print('Sending {type} scenario "{scenario}" to demandtools'.format(type=self.scenario_type, scenario=self.scenario_nice_name))
-
-        if self.debug:
-            self._print(self.demand_tools_args)
-        with subprocess.Popen(self.demand_tools_args,stdout=subprocess.PIPE,stderr=subprocess.PIPE,startupinfo=self._startupinfo) as proc:
-            stdout,stderr = proc.communicate()
-            if stderr:
-                exception = DemandToolsExceptionFactory(stderr.decode())(stderr)
-                if type(exception) in self.exceptions_to_retry_on and self.retry_count>self._retried_count:
-                    self._retried_count+=1
-                    self._print('Encountered {e} which was specified as a "retry error". Retrying (retry {n}/{d}) - {pname}'.format(
-                        e=type(exception).__name__,
-                        n=self._retried_count,
-                        d=self.retry_count,
-                        pname=self.scenario_nice_name
-                    ))
-                    self.run()
-                    return
-                else:
-                    self.raise_exception(exception)
-                
+        #only the demandtools call itself is repeated when retrying
+        while True:
+            self._print('Sending {type} scenario "{scenario}" to demandtools'.format(type=self.scenario_type, scenario=self.scenario_nice_name))
+
+            if self.debug:
+                self._print(self.demand_tools_args)
+            #stdout is never used and would block demandtools once the pipe filled up, so it's discarded
+            #psutil's priority classes are Windows process creation flags, so demandtools starts at process_priority along with anything it launches.
+            #this process isn't niced since other commands share it when running on threads
+            with subprocess.Popen(self.demand_tools_args,stdout=subprocess.DEVNULL,stderr=subprocess.PIPE,startupinfo=self._startupinfo,creationflags=self.process_priority) as proc:
+                stderr = bytearray()
+                for line in proc.stderr:
+                    stderr += line
+                    #only the tail is kept, the exception factory looks for demandtools' closing error message.
+                    #sentences cut off by the trim aren't matched
+                    if len(stderr)>_STDERR_TAIL_SIZE:
+                        del stderr[:-_STDERR_TAIL_SIZE]
+                returncode = proc.wait()
+                stderr = bytes(stderr)
+                if stderr:
+                    exception = DemandToolsExceptionFactory(stderr)(stderr)
+                    if type(exception) in self.exceptions_to_retry_on and self.retry_count>self._retried_count:
+                        self._retried_count+=1
+                        self._print('Encountered {e} which was specified as a "retry error". Retrying (retry {n}/{d}) - {pname}'.format(
+                            e=type(exception).__name__,
+                            n=self._retried_count,
+                            d=self.retry_count,
+                            pname=self.scenario_nice_name
+                        ))
+                        continue
+                    else:
+                        self.raise_exception(exception)
+                elif returncode:
+                    self.raise_exception(DemandToolsCommandException('demandtools exited with code {c} without writing an error'.format(c=returncode)))
+            break
+
         self._print('demandtools is done processing {scenario}'.format(scenario=self.scenario_nice_name))
         if self.post_run_func:
             self.post_run_func(*self.post_run_func_args,**self.post_run_func_kwargs)
+
+class DemandToolsRunner():
+    '''
+    runs DemandToolsCommands concurrently on a thread pool. The python side of a command only launches demandtools and waits on it,
+    so a thread does the job without spawning an interpreter per command. Set use_process to run each command in its own process instead,
+    isolating the commands from each other at the cost of the spawn
+    '''
+    def __init__(self,max_workers=None,use_process=False):
+        self.use_process=use_process
+        self._executor=ThreadPoolExecutor(max_workers=max_workers,thread_name_prefix='DemandToolsRunner')
+
+    def __exit__(self,type,value,traceback):
+        self.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def submit(self,command):
+        '''
+        returns a concurrent.futures.Future that raises whatever the command raised. With use_process the exception is sent back from the command's process,
+        one that can't be pickled is reported as a DemandToolsCommandException with the process' exit code
+        '''
+        if self.use_process:
+            return self._executor.submit(self._run_in_process,command)
+        return self._executor.submit(command.execute)
+
+    def run_all(self,commands):
+        '''submits every command and waits for all of them, raising the first exception encountered in submission order'''
+        futures = [self.submit(command) for command in commands]
+        for future in futures:
+            future.result()
+
+    def shutdown(self,wait=True):
+        self._executor.shutdown(wait=wait)
+
+    @staticmethod
+    def _run_in_process(command):
+        #the thread only waits on the process, this way max_workers limits the number of processes as well
+        receiver,command._exception_connection = Pipe(duplex=False)
+        try:
+            command.start()
+        finally:
+            #the process has its own copy, once it exits recv raises EOFError instead of blocking
+            command._exception_connection.close()
+            command._exception_connection = None
+        try:
+            #read before joining so a large exception can't block the process on a full pipe
+            exception = receiver.recv()
+        except EOFError:
+            exception = None
+        finally:
+            receiver.close()
+        command.join()
+        if exception is not None:
+            raise exception
+        if command.exitcode:
+            raise DemandToolsCommandException('{name} Process exited with code {code}'.format(name=command.name,code=command.exitcode))
             
 def preflight_checks():
     if CONFIG.LOGDIRECTORY_ENVIRONMENT_VARIABLE not in os.environ: